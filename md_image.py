@@ -1,9 +1,13 @@
 import sublime
 import sublime_plugin
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import struct
-import imghdr
 import base64
+import hashlib
+import json
+import http.client
+import urllib.error
 import urllib.request
 import urllib.parse
 import io
@@ -11,11 +15,44 @@ import os.path
 import subprocess
 import sys
 import re
+import socket
+import time
 
 DEBUG = False
 
-LEADING_WHITESPACE_REGEX = re.compile("^([ \t]*)")
-IMAGE_ATTRIBUTES_REGEX = re.compile(r'.*\)\{(.*)\}')
+# Number of remote images downloaded concurrently
+MAX_DOWNLOAD_WORKERS = 8
+# Seconds to wait for a connection to a remote image server
+REMOTE_CONNECT_TIMEOUT = 5
+# Seconds to wait on a connected remote image server before giving up
+REMOTE_READ_TIMEOUT = 15
+# Number of times to retry a remote image request that failed to connect
+REMOTE_RETRIES = 2
+# Seconds to wait on the HEAD request sent before downloading an image
+REMOTE_HEAD_TIMEOUT = 5
+# Remote images larger than this many bytes are not downloaded
+MAX_REMOTE_BYTES = 10 * 1024 * 1024
+# Links starting with these are always remote, whatever the platform
+REMOTE_URL_PREFIXES = ('http://', 'https://', 'ftp://')
+# Number of local image sizes remembered between runs
+LOCAL_SIZE_CACHE_SIZE = 512
+# Bytes of a JPEG read at a time while looking for its size
+JPEG_CHUNK_SIZE = 4096
+# Number of downloaded remote images kept in memory per view
+REMOTE_URL_CACHE_SIZE = 64
+# Total bytes of downloaded remote images kept in memory per view. Images
+# dropped from memory are loaded again from the remote image cache.
+REMOTE_URL_CACHE_BYTES = 32 * 1024 * 1024
+# Directory under Sublime's cache path where downloaded images are kept
+REMOTE_CACHE_DIR = 'MarkdownImages'
+REMOTE_CACHE_INDEX = 'index.json'
+# Total bytes of downloaded images kept in the remote image cache
+REMOTE_CACHE_MAX_BYTES = 100 * 1024 * 1024
+# Seconds a cached image without an ETag or Last-Modified header is used
+# before it is downloaded again
+REMOTE_CACHE_MAX_AGE = 24 * 60 * 60
+
+IMAGE_ATTRIBUTES_REGEX = re.compile(r'\)\{([^}]*)\}')
 
 def debug(*args, **kwargs):
     if DEBUG:
@@ -39,10 +76,12 @@ class MarkdownImagesPlugin(sublime_plugin.EventListener):
             return
         if not self._should_run_for_extension(settings, view):
             return
-        self._update_images(settings,
-                            view,
-                            show_local=show_local,
-                            show_remote=show_remote)
+        # Loading images reads files and downloads URLs, so keep it off the
+        # UI thread
+        sublime.set_timeout_async(lambda: self._update_images(settings,
+                                                              view,
+                                                              show_local=show_local,
+                                                              show_remote=show_remote), 0)
 
     def on_post_save(self, view):
         settings = get_settings()
@@ -52,10 +91,12 @@ class MarkdownImagesPlugin(sublime_plugin.EventListener):
             return
         if not self._should_run_for_extension(settings, view):
             return
-        self._update_images(settings,
-                            view,
-                            show_local=show_local,
-                            show_remote=show_remote)
+        # Loading images reads files and downloads URLs, so keep it off the
+        # UI thread
+        sublime.set_timeout_async(lambda: self._update_images(settings,
+                                                              view,
+                                                              show_local=show_local,
+                                                              show_remote=show_remote), 0)
 
     def on_close(self, view):
         ImageHandler.on_close(view)
@@ -72,7 +113,6 @@ class MarkdownImagesPlugin(sublime_plugin.EventListener):
     def _update_images(self, settings, view, **kwargs):
         max_width = settings.get('img_maxwidth', None)
         base_path = settings.get('base_path', None)
-        ImageHandler.hide_images(view)
         ImageHandler.show_images(view,
                                  max_width=max_width,
                                  show_local=kwargs.get('show_local', False),
@@ -86,10 +126,13 @@ class ImageHandler:
     """
 
     selector = 'markup.underline.link.image.markdown'
-    # Maps view IDs to sets of phantom (key, html) pairs
-    phantoms = defaultdict(set)
+    # Maps view IDs to their sublime.PhantomSet
+    phantom_sets = {}
+    # Maps view IDs to {phantom ID: hash} of the line each phantom was created from
+    line_hashes = {}
     # Cached remote URL image data. Kept even if not rendered.
-    cached_remote_urls = defaultdict(dict)
+    cached_remote_urls = defaultdict(lambda: LRUCache(REMOTE_URL_CACHE_SIZE, REMOTE_URL_CACHE_BYTES,
+                                                      lambda remote_data: len(remote_data[0])))
 
     @staticmethod
     def on_close(view):
@@ -99,6 +142,11 @@ class ImageHandler:
     @staticmethod
     def show_images(view, max_width=None, show_local=True, show_remote=False, base_path=""):
         debug("show_images")
+        # This runs on the async thread, so the view may have been closed
+        # since it was scheduled
+        if not view.is_valid():
+            debug("view closed")
+            return
         if not show_local and not show_remote:
             debug("doing nothing")
             return
@@ -109,7 +157,10 @@ class ImageHandler:
         if not max_width or max_width < 0:
             max_width = 1024
 
+        vid = view.id()
+        # Maps start points to the phantoms to show
         phantoms = {}
+        new_line_hashes = {}
         img_regs = view.find_by_selector(ImageHandler.selector)
 
         # Handling space characters in image links
@@ -117,50 +168,83 @@ class ImageHandler:
         # are parsed by sublime as multiple links instead of one.
         # Example: "![](my file.png)" gets parsed as two links: "my" and "file.png".
         # We detect when two links are separated only by spaces and merge them
-        indexes_to_merge = []
-        for i, (left_reg, right_reg) in enumerate(zip(img_regs, img_regs[1:])):
-            try:
-                inter_region = sublime.Region(left_reg.end(), right_reg.begin())
-                if (view.substr(inter_region)).isspace():
-                    # the inter_region is all spaces
-                    # Noting that left and right regions must be merged
-                    indexes_to_merge += [i + 1]
-            except UnicodeDecodeError as e:
-                print("Warning: MarkdownImages: error handling space characters in line starting at character %d: %s" % (left_reg.a, e))
-
         new_img_regs = []
-        for i in range(len(img_regs)):
-            if i in indexes_to_merge:
-                new_img_regs[-1] = new_img_regs[-1].cover(img_regs[i])
-            else:
-                new_img_regs += [img_regs[i]]
+        for right_reg in img_regs:
+            if new_img_regs:
+                left_reg = new_img_regs[-1]
+                try:
+                    inter_region = sublime.Region(left_reg.end(), right_reg.begin())
+                    if (view.substr(inter_region)).isspace():
+                        # the inter_region is all spaces, so merge the
+                        # right region into the left one
+                        new_img_regs[-1] = left_reg.cover(right_reg)
+                        continue
+                except UnicodeDecodeError as e:
+                    print("Warning: MarkdownImages: error handling space characters in line starting at character %d: %s" % (left_reg.a, e))
+            new_img_regs.append(right_reg)
         img_regs = new_img_regs
 
-        for region in reversed(img_regs):
+        # Find where the phantoms from the last run are now, since
+        # editing may have moved them
+        phantom_set = ImageHandler.phantom_sets.get(vid)
+        shown = {}
+        if phantom_set is not None:
+            regions = view.query_phantoms([p.id for p in phantom_set.phantoms])
+            shown = {r.a: p for r, p in zip(regions, phantom_set.phantoms)}
+        line_hashes = ImageHandler.line_hashes.get(vid, {})
+        options = (max_width, show_local, show_remote, base_path, view.file_name())
+
+        links = []
+        for region in img_regs:
             line_region = view.line(region)
-            print("## In reversed list, looking at region (%d,%d) [%s]" % (region.a, region.b, view.substr(region)))
-            image_data = None
-            rel_p = view.substr(region)
-
-            # If an image link is enclosed in <> to tolerate spaces in it,
-            # then the > appears at the end of rel_p for some reason.
-            # This character makes the link invalid, so it must be removed
-            if rel_p[-1] == '>':
-                rel_p = rel_p[0:-1]
-
-            # (Windows) cutting the drive letter from the path,
-            # otherwise urlparse interprets it as a scheme (like 'file' or 'http')
-            # and generates a bogus url object like:
-            # url= ParseResult(scheme='c', netloc='', path='/path/image.png', params='', query='', fragment='')
-            drive_letter, rel_p = os.path.splitdrive(rel_p)
 
-            url = urllib.parse.urlparse(rel_p)
+            # Force the phantom image view to append below the first non-whitespace character in the line.
+            # Otherwise, the phantom image view interlaces in between
+            # word-wrapped lines
+            line = view.substr(line_region)
+            whitespace_len = len(line) - len(line.lstrip(' \t'))
+            start_point = line_region.a + whitespace_len
+
+            drive_letter, rel_p, url = ImageHandler._parse_link(view, region)
+
+            # Skip remote images on lines that haven't changed since their
+            # phantom was created. Local images are always looked at again,
+            # so a file replaced on disk is picked up (its size is cached
+            # by mtime, so this is cheap).
+            line_hash = hash((line, options))
+            old_phantom = shown.get(start_point)
+            if (is_remote_url(url) and old_phantom is not None and
+                    line_hashes.get(old_phantom.id) == line_hash):
+                debug("Line unchanged")
+                phantoms[start_point] = ImageHandler._create_phantom(start_point, old_phantom.content)
+                new_line_hashes[start_point] = line_hash
+                continue
+
+            links.append((region, line_region, start_point, line_hash, drive_letter, rel_p, url))
+
+        # Download the remote images up front, all at once, rather than
+        # waiting on each request in turn below
+        prefetched = {}
+        if show_remote:
+            prefetched = ImageHandler._prefetch_remote_images(view, links)
+
+        # The view may have been closed while the images were downloading.
+        # Its state was dropped by on_close(), so don't bring it back.
+        if not view.is_valid():
+            debug("view closed")
+            return
+        remote_cache = ImageHandler.cached_remote_urls[vid]
+
+        for region, line_region, start_point, line_hash, drive_letter, rel_p, url in reversed(links):
+            debug("looking at region", region, rel_p)
+            remote_data = None
             try:
-                if url.scheme and url.scheme != 'file':
-                    img_src, h, w, file_type, url, image_data = ImageHandler.prepare_remote_image(rel_p,
+                if is_remote_url(url):
+                    img_src, h, w, file_type, url, remote_data = ImageHandler.prepare_remote_image(rel_p,
                                                                                                                  show_remote,
                                                                                                                  url,
-                                                                                                                 view)
+                                                                                                                 view,
+                                                                                                                 prefetched)
                 else:
                     img_src, h, w, file_type, url = ImageHandler.prepare_local_image(base_path,
                                                                                                     drive_letter,
@@ -168,6 +252,10 @@ class ImageHandler:
                                                                                                     view)
             except SkipImageException:
                 continue
+            except Exception as e:
+                # Don't let one bad link stop the rest from showing
+                print("Warning: %s" % e)
+                continue
             # PreparedImageDetails now contains :
             #       html_template, h, w, img_src, file_type, url, urldata
 
@@ -181,45 +269,94 @@ class ImageHandler:
                 print("Warning: MarkdownImages: error fetching image attributes in line starting at character %d: %s" % (region.a, e))
                 continue
 
-            # Force the phantom image view to append below the first non-whitespace character in the line.
-            # Otherwise, the phantom image view interlaces in between
-            # word-wrapped lines
-            line = view.substr(line_region)
-            whitespace = LEADING_WHITESPACE_REGEX.search(line).group(1)
-            start_point = line_region.a + len(whitespace)
-            key = 'mdimage-' + str(start_point)
-
             html = u'''
                     <a href="%s">
                         <img src="%s" class="centerImage" %s>
                     </a>
                 ''' % (url.geturl(), img_src, img_attributes)
 
-            phantom = (key, html)
-            phantoms[key] = phantom
-            if phantom in ImageHandler.phantoms[view.id()]:
-                debug("Phantom unchanged")
-                continue
+            debug("Creating phantom at", start_point)
+            phantoms[start_point] = ImageHandler._create_phantom(start_point, html)
+            new_line_hashes[start_point] = line_hash
+            if remote_data is not None:
+                remote_cache[rel_p] = remote_data
+
+        if not view.is_valid():
+            debug("view closed")
+            return
+
+        # The phantom set keeps phantoms whose region and HTML are unchanged,
+        # and adds or erases the rest one by one
+        if phantom_set is None:
+            phantom_set = ImageHandler.phantom_sets[vid] = sublime.PhantomSet(view, 'mdimage')
+        phantom_set.update(list(phantoms.values()))
+        # Phantom IDs are only known after the update
+        ImageHandler.line_hashes[vid] = {p.id: new_line_hashes[point] for point, p in phantoms.items()}
+
+        if not phantoms:
+            ImageHandler._forget_view(vid)
+
+    @staticmethod
+    def _create_phantom(start_point, html):
+        return sublime.Phantom(sublime.Region(start_point),
+                               html,
+                               sublime.LAYOUT_BELOW,
+                               ImageHandler.on_navigate)
+
+    @staticmethod
+    def _parse_link(view, region):
+        """
+        Returns the (drive_letter, rel_p, url) of the image link in region.
+        """
+        rel_p = view.substr(region)
+
+        # If an image link is enclosed in <> to tolerate spaces in it,
+        # then the > appears at the end of rel_p for some reason.
+        # This character makes the link invalid, so it must be removed
+        if rel_p[-1] == '>':
+            rel_p = rel_p[0:-1]
+
+        # (Windows) cutting the drive letter from the path,
+        # otherwise urlparse interprets it as a scheme (like 'file' or 'http')
+        # and generates a bogus url object like:
+        # url= ParseResult(scheme='c', netloc='', path='/path/image.png', params='', query='', fragment='')
+        # URLs can't start with a drive letter, so they don't need checking
+        if rel_p.startswith(REMOTE_URL_PREFIXES):
+            drive_letter = ''
+        else:
+            drive_letter, rel_p = os.path.splitdrive(rel_p)
+
+        url = urllib.parse.urlparse(rel_p)
+        return drive_letter, rel_p, url
 
-            debug("Creating phantom", phantom[0])
-            print("## Creating phantom. Start point is %d" % start_point)
-            view.add_phantom(phantom[0],
-                             sublime.Region(start_point),
-                             phantom[1],
-                             sublime.LAYOUT_BELOW,
-                             ImageHandler.on_navigate)
-            ImageHandler.phantoms[view.id()].add(phantom)
-            if image_data is not None:
-                ImageHandler.cached_remote_urls[view.id()][rel_p] = image_data
-
-        # Erase leftover phantoms
-        for p in list(ImageHandler.phantoms[view.id()]):
-            if phantoms.get(p[0]) != p:
-                view.erase_phantoms(p[0])
-                ImageHandler.phantoms[view.id()].remove(p)
-
-        if not ImageHandler.phantoms[view.id()]:
-            ImageHandler.phantoms.pop(view.id(), None)
+    @staticmethod
+    def _prefetch_remote_images(view, links):
+        """
+        Download all uncached remote images concurrently.
+        Returns a dict mapping each URL to the result of fetch_remote_image(),
+        or to the exception raised while downloading it.
+        """
+        cache = ImageHandler.cached_remote_urls.get(view.id(), {})
+        urls = {rel_p for *_, rel_p, url in links
+                if is_remote_url(url) and not url.path.endswith('.svg') and
+                not cache.get(rel_p)}
+        prefetched = {}
+        if not urls:
+            return prefetched
+
+        # Load the index here, rather than racing to load it in each worker
+        get_remote_cache_index()
+
+        debug("prefetching %d remote images" % len(urls))
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+            futures = {executor.submit(fetch_remote_image, u): u for u in urls}
+            for future in as_completed(futures):
+                u = futures[future]
+                try:
+                    prefetched[u] = future.result()
+                except Exception as e:
+                    prefetched[u] = e
+        return prefetched
 
     @staticmethod
     def get_adjusted_img_attributes(h, w, max_width, line_region, region, view):
@@ -289,35 +426,27 @@ class ImageHandler:
         return img_src, h, w, file_type, url
 
     @staticmethod
-    def prepare_remote_image(rel_p, show_remote, url, view):
+    def prepare_remote_image(rel_p, show_remote, url, view, prefetched=None):
         if not show_remote:
             raise SkipImageException()
 
         # We can't render SVG images, so skip the request
-        # Note: not all URLs that return SVG end with .svg
-        # We could use a HEAD request to check the Content-Type before
-        # downloading the image, but the size of an SVG is typically
-        # so small to not be worth the extra request
+        # Note: not all URLs that return SVG end with .svg, those are
+        # caught by the HEAD request in fetch_remote_image()
         if url.path.endswith('.svg'):
             print("MarkdownImages: We can't render SVG images yet, sorry.")
             raise SkipImageException()
 
         debug("image url", rel_p)
-        image_data = ImageHandler.cached_remote_urls[view.id()].get(rel_p)
-        if not image_data:
-            try:
-                response = urllib.request.urlopen(rel_p)
-            except Exception as e:
-                msg = "MarkdownImages: Failed to open URL [%s]" % rel_p
-                debug(msg, e)
-                raise Exception(msg) from e
-
-            try:
-                image_data = response.read()
-            except Exception as e:
-                msg = "MarkdownImages: Failed to read data from URL [%s]" % rel_p
-                debug(msg, e)
-                raise Exception(msg) from e
+        remote_data = ImageHandler.cached_remote_urls.get(view.id(), {}).get(rel_p)
+        if not remote_data and prefetched:
+            remote_data = prefetched.get(rel_p)
+            # Don't retry a download that already failed during the prefetch
+            if isinstance(remote_data, Exception):
+                raise remote_data
+        if not remote_data:
+            remote_data = fetch_remote_image(rel_p)
+        image_data, etag, last_modified, fetched = remote_data
         try:
             w, h, file_type = get_image_size(io.BytesIO(image_data))
         except Exception as e:
@@ -325,9 +454,23 @@ class ImageHandler:
             debug(msg, e)
             raise Exception(msg) from e
 
-        b64_data = base64.encodestring(image_data).decode('ascii').replace('\n', '')
-        img_src = "data:image/%s;base64,%s" % (file_type, b64_data)
-        return img_src, h, w, file_type, url, image_data
+        if not file_type:
+            return None, h, w, file_type, url, remote_data
+
+        # Point the phantom at a cached copy of the image on disk, instead
+        # of inlining it as a (much larger) base64 data URL
+        try:
+            # Images shown in open views must not be evicted from the cache
+            # on_close() can drop a view's cache meanwhile, so loop over a copy
+            in_use = {u for cache in list(ImageHandler.cached_remote_urls.values()) for u in cache}
+            in_use.add(rel_p)
+            img_src = get_file_url(store_remote_image(rel_p, image_data, file_type, etag, last_modified, fetched,
+                                                      in_use))
+        except OSError as e:
+            print("Warning: MarkdownImages: Failed to cache data from URL [%s]: %s" % (rel_p, e))
+            b64_data = base64.b64encode(image_data).decode('ascii')
+            img_src = "data:image/%s;base64,%s" % (file_type, b64_data)
+        return img_src, h, w, file_type, url, remote_data
 
     @staticmethod
     def on_navigate(url):
@@ -341,27 +484,336 @@ class ImageHandler:
 
     @staticmethod
     def _erase_phantoms(view):
-        for p in ImageHandler.phantoms[view.id()]:
-            view.erase_phantoms(p[0])
-        ImageHandler.phantoms.pop(view.id(), None)
+        phantom_set = ImageHandler.phantom_sets.get(view.id())
+        if phantom_set is not None:
+            phantom_set.update([])
+        ImageHandler._forget_view(view.id())
+
+    @staticmethod
+    def _forget_view(vid):
+        ImageHandler.phantom_sets.pop(vid, None)
+        ImageHandler.line_hashes.pop(vid, None)
         # Cached URL data is kept
 
 
+class ConnectTimeoutMixin:
+    """
+    Connect with at most REMOTE_CONNECT_TIMEOUT, then use the connection's
+    own timeout for reading the response.
+    """
+
+    def connect(self):
+        read_timeout = self.timeout
+        if isinstance(read_timeout, (int, float)):
+            self.timeout = min(read_timeout, REMOTE_CONNECT_TIMEOUT)
+        try:
+            super().connect()
+        finally:
+            self.timeout = read_timeout
+        self.sock.settimeout(read_timeout)
+
+
+class ConnectTimeoutHTTPConnection(ConnectTimeoutMixin, http.client.HTTPConnection):
+    pass
+
+
+class ConnectTimeoutHTTPSConnection(ConnectTimeoutMixin, http.client.HTTPSConnection):
+    pass
+
+
+class ConnectTimeoutHTTPHandler(urllib.request.HTTPHandler):
+
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(ConnectTimeoutHTTPConnection, req, **kwargs)
+
+
+class ConnectTimeoutHTTPSHandler(urllib.request.HTTPSHandler):
+
+    def do_open(self, http_class, req, **kwargs):
+        return super().do_open(ConnectTimeoutHTTPSConnection, req, **kwargs)
+
+
+# Used for all remote image requests, so that connecting to a server
+# times out sooner than waiting on one that is sending the image
+url_opener = urllib.request.build_opener(ConnectTimeoutHTTPHandler, ConnectTimeoutHTTPSHandler)
+
+
+class LRUCache(OrderedDict):
+    """
+    Dict that only keeps its maxsize most recently used entries.
+    If maxbytes is given, the least recently used entries are also dropped
+    while the sizeof() their values adds up to more than maxbytes.
+    """
+
+    def __init__(self, maxsize, maxbytes=None, sizeof=len):
+        super().__init__()
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
+        super().__setitem__(key, value)
+        if self.maxbytes is not None:
+            self.nbytes += self.sizeof(value)
+        # Always keep the entry just added
+        while len(self) > 1 and (len(self) > self.maxsize or
+                                 self.maxbytes is not None and self.nbytes > self.maxbytes):
+            del self[next(iter(self))]
+
+    def __delitem__(self, key):
+        if self.maxbytes is not None:
+            self.nbytes -= self.sizeof(self[key])
+        super().__delitem__(key)
+
+
+# Maps (file_path, mtime, size) of local images to their (w, h, file_type)
+local_size_cache = LRUCache(LOCAL_SIZE_CACHE_SIZE)
+
+# Maps remote image URLs to {'file', 'size', 'etag', 'last_modified', 'fetched'}
+# of their file in the remote image cache directory. Loaded from disk on
+# first use.
+remote_cache_index = None
+
+
+def is_remote_url(url):
+    return bool(url.scheme) and url.scheme != 'file'
+
+
+def fetch_remote_image(url):
+    """
+    Download the image at url, and return its
+    (image_data, etag, last_modified, fetched), where fetched is the time
+    the server was last asked for it.
+
+    If the image is in the remote image cache, it is only downloaded again
+    when the server says it has changed since. Cached images the server
+    gave no ETag or Last-Modified for are used as they are until they are
+    REMOTE_CACHE_MAX_AGE old.
+    """
+    entry = get_remote_cache_index().get(url)
+    cached_data = load_cached_remote_image(url)
+    headers = {}
+    if cached_data:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        fetched = entry.get('fetched', 0)
+        if not headers and time.time() - fetched < REMOTE_CACHE_MAX_AGE:
+            return cached_data, None, None, fetched
+    else:
+        check_remote_image(url)
+
+    request = urllib.request.Request(url, headers=headers)
+    attempt = 0
+    while True:
+        try:
+            response = url_opener.open(request, timeout=REMOTE_READ_TIMEOUT)
+            break
+        except Exception as e:
+            if cached_data and isinstance(e, urllib.error.HTTPError) and e.code == 304:
+                debug("image not modified", url)
+                return cached_data, entry.get('etag'), entry.get('last_modified'), time.time()
+            # An HTTPError means the server answered, so retrying won't help
+            retryable = (isinstance(e, (urllib.error.URLError, socket.timeout)) and
+                         not isinstance(e, urllib.error.HTTPError))
+            if retryable and attempt < REMOTE_RETRIES:
+                attempt += 1
+                debug("retrying URL", url, e)
+                continue
+            msg = "MarkdownImages: Failed to open URL [%s]" % url
+            debug(msg, e)
+            raise Exception(msg) from e
+
+    try:
+        with response:
+            check_remote_image_size(url, int(response.headers.get('Content-Length') or 0))
+            # Read at most one byte past the limit, to tell if it was exceeded
+            image_data = response.read(MAX_REMOTE_BYTES + 1)
+    except SkipImageException:
+        raise
+    except Exception as e:
+        msg = "MarkdownImages: Failed to read data from URL [%s]" % url
+        debug(msg, e)
+        raise Exception(msg) from e
+    check_remote_image_size(url, len(image_data))
+    return image_data, response.headers.get('ETag'), response.headers.get('Last-Modified'), time.time()
+
+
+def check_remote_image(url):
+    """
+    Send a HEAD request for url, and raise SkipImageException if the
+    response shows it's an image we wouldn't render anyway.
+    Errors are ignored, since not every server supports HEAD.
+    """
+    try:
+        request = urllib.request.Request(url, method='HEAD')
+        with url_opener.open(request, timeout=REMOTE_HEAD_TIMEOUT) as response:
+            content_type = response.headers.get('Content-Type', '')
+            content_length = int(response.headers.get('Content-Length') or 0)
+    except Exception as e:
+        debug("HEAD request failed", url, e)
+        return
+
+    if content_type.startswith('image/svg'):
+        print("MarkdownImages: We can't render SVG images yet, sorry.")
+        raise SkipImageException()
+    check_remote_image_size(url, content_length)
+
+
+def check_remote_image_size(url, size):
+    if size > MAX_REMOTE_BYTES:
+        print("MarkdownImages: Skipping image larger than %d bytes [%s]" % (MAX_REMOTE_BYTES, url))
+        raise SkipImageException()
+
+
+def get_remote_cache_dir():
+    cache_dir = os.path.join(sublime.cache_path(), REMOTE_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_remote_cache_index():
+    global remote_cache_index
+    if remote_cache_index is None:
+        try:
+            with open(os.path.join(get_remote_cache_dir(), REMOTE_CACHE_INDEX)) as f:
+                index = json.load(f)
+            # Skip entries in an outdated format
+            remote_cache_index = {url: entry for url, entry in index.items()
+                                  if isinstance(entry, dict) and entry.get('file')}
+        except (OSError, ValueError, AttributeError) as e:
+            debug("unable to load remote cache index", e)
+            remote_cache_index = {}
+    return remote_cache_index
+
+
+def save_remote_cache_index():
+    path = os.path.join(get_remote_cache_dir(), REMOTE_CACHE_INDEX)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(get_remote_cache_index(), f)
+    os.replace(path + '.tmp', path)
+
+
+def load_cached_remote_image(url):
+    """
+    Returns the image data previously downloaded from url, or None if the
+    image isn't in the remote image cache.
+    """
+    entry = get_remote_cache_index().get(url)
+    if not entry:
+        return None
+    try:
+        with open(os.path.join(get_remote_cache_dir(), entry['file']), 'rb') as f:
+            return f.read()
+    except OSError as e:
+        debug("unable to load cached image", url, e)
+        return None
+
+
+def store_remote_image(url, image_data, file_type, etag, last_modified, fetched, in_use):
+    """
+    Writes image_data to the remote image cache and returns its path.
+    Files are named by content, so the same image is only stored once.
+    The etag and last_modified response headers are kept to revalidate
+    the image later. The URLs in in_use are never evicted.
+    """
+    name = hashlib.sha1(image_data).hexdigest() + '.' + file_type
+    path = os.path.join(get_remote_cache_dir(), name)
+    if not os.path.exists(path):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(image_data)
+        os.replace(path + '.tmp', path)
+
+    entry = {'file': name, 'size': len(image_data), 'etag': etag,
+             'last_modified': last_modified, 'fetched': fetched}
+    index = get_remote_cache_index()
+    old_entry = index.get(url)
+    if old_entry != entry:
+        index[url] = entry
+        # The URL's image changed, so its old file may no longer be needed
+        if old_entry and old_entry['file'] != name:
+            remove_unused_cache_file(old_entry['file'])
+        evict_remote_cache(in_use)
+        save_remote_cache_index()
+    return path
+
+
+def remove_unused_cache_file(name):
+    """
+    Delete a file from the remote image cache, unless another URL still
+    uses it. Returns True if the file was deleted.
+    """
+    if any(entry['file'] == name for entry in get_remote_cache_index().values()):
+        return False
+    try:
+        os.remove(os.path.join(get_remote_cache_dir(), name))
+    except OSError as e:
+        debug("unable to remove cached image", name, e)
+    return True
+
+
+def evict_remote_cache(in_use):
+    """
+    Drop the least recently fetched images, apart from those for the URLs
+    in in_use, until the remote image cache fits in REMOTE_CACHE_MAX_BYTES.
+    """
+    index = get_remote_cache_index()
+    # Several URLs can share a file
+    sizes = {entry['file']: entry.get('size', 0) for entry in index.values()}
+    total = sum(sizes.values())
+    for url in sorted(index, key=lambda u: index[u].get('fetched', 0)):
+        if total <= REMOTE_CACHE_MAX_BYTES:
+            break
+        if url in in_use:
+            continue
+        name = index.pop(url)['file']
+        if remove_unused_cache_file(name):
+            total -= sizes[name]
+
+
+def get_file_url(file_path):
+    url = urllib.parse.urlunparse(('file', '', file_path, '', '', ''))
+    # (Windows) urlunparse adds a third slash after 'file://',
+    # see prepare_local_image()
+    if os.path.splitdrive(file_path)[0]:
+        url = url.replace('file:///', 'file://', 1)
+    return url
+
+
 def get_provided_img_attributes(view, line_region, link_region=None):
     # find attrs for this link
     full_line = view.substr(line_region)
     link_till_eol = full_line[link_region.a - line_region.a:]
     # find attr if present
-    print("## Attrs is [%s]" % link_till_eol)
-    m = re.match(IMAGE_ATTRIBUTES_REGEX, link_till_eol)
+    debug("attrs", link_till_eol)
+    m = IMAGE_ATTRIBUTES_REGEX.search(link_till_eol)
     if m:
         return m.groups()[0]
     return ''
 
 
 def get_file_image_size(file_path):
+    # The file is only parsed again once it has been modified
+    st = os.stat(file_path)
+    key = (file_path, st.st_mtime_ns, st.st_size)
+    result = local_size_cache.get(key)
+    if result is not None:
+        return result
+
     with open(file_path, 'rb') as f:
-        return get_image_size(f)
+        result = get_image_size(f)
+    local_size_cache[key] = result
+    return result
 
 
 def get_image_size(f):
@@ -375,34 +827,19 @@ def get_image_size(f):
     debug(str(head[:4]))
     debug(head[:4] == b'<svg')
 
-    if imghdr.what('', head) == 'png':
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
         debug('detected png')
         file_type = "png"
-        check = struct.unpack('>i', head[4:8])[0]
-        if check != 0x0d0a1a0a:
-            return None, None, file_type
         width, height = struct.unpack('>ii', head[16:24])
-    elif imghdr.what('', head) == 'gif':
+    elif head[:6] in (b'GIF87a', b'GIF89a'):
         debug('detected gif')
         file_type = "gif"
         width, height = struct.unpack('<HH', head[6:10])
-    elif imghdr.what('', head) == 'jpeg':
+    elif head[:3] == b'\xff\xd8\xff':
         debug('detected jpeg')
         file_type = "jpeg"
         try:
-            f.seek(0)  # Read 0xff next
-            size = 2
-            ftype = 0
-            while not 0xc0 <= ftype <= 0xcf:
-                f.seek(size, 1)
-                byte = f.read(1)
-                while ord(byte) == 0xff:
-                    byte = f.read(1)
-                ftype = ord(byte)
-                size = struct.unpack('>H', f.read(2))[0] - 2
-            # SOFn block
-            f.seek(1, 1)  # skip precision byte.
-            height, width = struct.unpack('>HH', f.read(4))
+            width, height = get_jpeg_size(f)
         except Exception as e:
             debug("determining jpeg image size failed", e)
             return None, None, file_type
@@ -418,6 +855,33 @@ def get_image_size(f):
     return width, height, file_type
 
 
+def get_jpeg_size(f):
+    """
+    Find the SOFn block of the JPEG in f and return its (width, height).
+    The file is read in chunks and walked by index, rather than with a
+    read() and seek() per segment.
+    """
+    f.seek(0)
+    buf = f.read(JPEG_CHUNK_SIZE)
+    i = 2  # skip the SOI marker
+    while True:
+        # Make sure the next segment's header is in the buffer
+        while len(buf) < i + 9:
+            chunk = f.read(JPEG_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("no SOFn block found")
+            buf += chunk
+        if buf[i] == 0xff:
+            i += 1
+            continue
+        ftype = buf[i]
+        if 0xc0 <= ftype <= 0xcf:
+            # SOFn block: length, precision byte, height, width
+            height, width = struct.unpack_from('>HH', buf, i + 4)
+            return width, height
+        i += 1 + struct.unpack_from('>H', buf, i + 1)[0]
+
+
 def get_path_for(view):
     """
     Returns the path of the current file in view.
@@ -441,11 +905,12 @@ class MarkdownImagesShowCommand(sublime_plugin.TextCommand):
         show_local = kwargs.get('show_local', True)
         show_remote = kwargs.get('show_remote', False)
         base_path = settings.get('base_path', None)
-        ImageHandler.show_images(self.view,
-                                 show_local=show_local,
-                                 show_remote=show_remote,
-                                 max_width=max_width,
-                                 base_path=base_path)
+        # Downloading remote images can take a while, so keep it off the UI thread
+        sublime.set_timeout_async(lambda: ImageHandler.show_images(self.view,
+                                                                   show_local=show_local,
+                                                                   show_remote=show_remote,
+                                                                   max_width=max_width,
+                                                                   base_path=base_path), 0)
 
 
 class MarkdownImagesHideCommand(sublime_plugin.TextCommand):